@@ -7,30 +7,56 @@ load_dotenv()
 import os
 import threading
 import logging
+import logging.handlers
+import atexit
 import asyncio
+import secrets
 import time
-
-from flask import Flask, request
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+import uuid
+import queue
+from collections import deque
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+import uvicorn
+from fastapi import FastAPI, Request as FastAPIRequest
+from fastapi.responses import PlainTextResponse
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Dispatcher, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram.utils.request import Request
 
 from telethon import TelegramClient
-
+from telethon.helpers import generate_random_long
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.types import InputFileBig
+from cachetools import TTLCache
+
+from hianimez_scraper import (
+    search_anime,
+    get_episodes_list,
+    extract_episode_stream_and_subtitle,
+    warm_connection,
+)
 from utils import (
     download_and_rename_subtitle,
     download_and_rename_video,
+    estimate_hls_size,
+    stream_hls_as_fragmented_mp4,
 )
 
 # ——————————————————————————————————————————————————————————————
 # 0) ALLOW‐LIST CONFIGURATION
 # ——————————————————————————————————————————————————————————————
 # Replace these numeric IDs with the actual Telegram user IDs you wish to allow.
-ALLOWED_USERS = {
+ALLOWED_USERS = frozenset({
     1423807625,
     # You can add more IDs like:
     # 123456789,
     # 987654321,
-}
+})
 
 DENIED_MESSAGE = (
     "🚫 *Access Denied\\!*  \n"
@@ -38,6 +64,47 @@ DENIED_MESSAGE = (
     "📩 Contact @THe\\_vK\\_3 for access\\!"
 )
 
+WELCOME_TEXT = (
+    "🌸 *Hianime Downloader* 🌸\n\n"
+    "🔍 *Find \\& Download Anime Episodes Directly*\n\n"
+    "🎯 *What I Can Do:*\n"
+    "• Search for your favorite anime on [hianimez\\.to](https://hianimez\\.to)\n"
+    "• Download SUB\\-HD2 video as high\\-quality MP4\n"
+    "• Include English subtitles \\(SRT/VTT\\)\n"
+    "• Send everything as a document \\(no quality loss\\)\n\n"
+    "📝 *How to Use:*\n"
+    "1️⃣ `/search <anime name>` \\- Find anime titles\n"
+    "2️⃣ Select the anime from the list of results\n"
+    "3️⃣ Choose an episode to download \\(or tap \\\"Download All\\\"\\)\n"
+    "4️⃣ Receive the high\\-quality MP4 \\+ subtitles automatically\n\n"
+    "📩 *Contact @THe\\_vK\\_3 if any problem or Query* "
+)
+
+# Header shown once an episode (or “All”) is picked; both fields must already be
+# MarkdownV2-escaped.
+DETAILS_TEMPLATE = (
+    "🔰 *Details Of Anime* 🔰\n\n"
+    "🎬 *Name:* {name}\n"
+    "🔢 *Episode:* {episode}"
+)
+
+# One-pass MarkdownV2 escaping for user-visible text such as anime titles: every
+# character the spec reserves (including the backslash itself) gets a backslash.
+_MDV2_TABLE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+
+# A denied user gets DENIED_MESSAGE at most once a minute, so someone spamming the
+# bot doesn't turn every update into an outgoing Bot API call.
+_denied_recently = TTLCache(maxsize=10_000, ttl=60)   # user_id → True
+_denied_lock = threading.Lock()
+
+def _should_send_denied(user_id: int) -> bool:
+    with _denied_lock:
+        if user_id in _denied_recently:
+            return False
+        _denied_recently[user_id] = True
+    logger.info(f"Denied access to user {user_id}")
+    return True
+
 # ——————————————————————————————————————————————————————————————
 # 1) Load environment variables
 # ——————————————————————————————————————————————————————————————
@@ -63,24 +130,124 @@ if not TELETHON_API_ID or not TELETHON_API_HASH:
     raise RuntimeError(
         "TELETHON_API_ID and TELETHON_API_HASH environment variables must be set."
     )
+try:
+    TELETHON_API_ID = int(TELETHON_API_ID)
+except ValueError:
+    raise RuntimeError(
+        f"TELETHON_API_ID must be the numeric api_id from my.telegram.org, got {TELETHON_API_ID!r}."
+    )
+
+# How many episodes “Download All” works on at once, and caps on the two heavy
+# stages so a slow ffmpeg run doesn't hold up uploads (or vice versa).
+ALL_EP_CONCURRENCY = int(os.getenv("ALL_EP_CONCURRENCY", "3"))
+MAX_PARALLEL_FFMPEG = int(os.getenv("MAX_PARALLEL_FFMPEG", "3"))
+MAX_PARALLEL_UPLOADS = int(os.getenv("MAX_PARALLEL_UPLOADS", "2"))
+EXTRACT_PREFETCH = int(os.getenv("EXTRACT_PREFETCH", "4"))
+# Total episode jobs (single taps and “Download All” batches together) running at once
+DL_WORKERS = int(os.getenv("DL_WORKERS", "8"))
+# Threads handling incoming updates (/search, button taps). Handlers spend nearly
+# all their time waiting on the network with the GIL released, so this can be
+# well above the CPU count; raise it if bursts of taps start to queue up.
+PTB_WORKERS = int(os.getenv("PTB_WORKERS", "16"))
+
+# Episodes estimated below this size skip the disk: ffmpeg's output is streamed
+# straight into a Bot API upload. The Bot API caps bot uploads at 50 MB, and the
+# estimate comes from the playlist bitrate, so leave some headroom.
+BOT_API_DIRECT_MAX_BYTES = 45 * 1024 * 1024
 
 # ——————————————————————————————————————————————————————————————
 # 2) Initialize Bot API + Dispatcher
 # ——————————————————————————————————————————————————————————————
-bot = Bot(token=BOT_TOKEN)
-dispatcher = Dispatcher(bot, None, workers=4, use_context=True)
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+# Keep-alive connection pool shared by everything that calls bot.*: the update
+# handlers (PTB_WORKERS), the episode jobs (DL_WORKERS), upload progress edits and
+# the keepalive thread. Size it for all of them so bursts don't hit "connection
+# pool is full".
+bot_request = Request(
+    con_pool_size=max(32, PTB_WORKERS + DL_WORKERS + 8),
+    connect_timeout=10,
+    read_timeout=120,
 )
+bot = Bot(token=BOT_TOKEN, request=bot_request)
+# Updates are handed to process_update on _update_executor (see the webhook), so
+# the Dispatcher's own pool only serves run_async callbacks, which aren't used.
+dispatcher = Dispatcher(bot, None, workers=1, use_context=True)
+
+# Handler threads only enqueue log records; the stderr write happens on the
+# listener's own thread, so a slow or blocked stderr never stalls a download.
+_log_queue = queue.Queue(-1)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # flush whatever is still queued on exit
+
+_root_logger = logging.getLogger()
+_root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_root_logger.setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+_ffmpeg_slots = threading.Semaphore(MAX_PARALLEL_FFMPEG)
+
+# Every episode job runs here instead of on a thread of its own, so a burst of
+# taps from many chats queues up rather than piling up OS threads.
+EXECUTOR = ThreadPoolExecutor(max_workers=DL_WORKERS, thread_name_prefix="dl")
+# Stream/subtitle lookups and subtitle downloads run alongside the episode jobs
+# that need them (these tasks never wait on anything, so they can't deadlock)
+_extract_pool = ThreadPoolExecutor(max_workers=EXTRACT_PREFETCH, thread_name_prefix="extract")
+
 # ——————————————————————————————————————————————————————————————
 # 3) In‐memory caches
 # ——————————————————————————————————————————————————————————————
-search_cache = {}           # chat_id → [ (title, slug), … ]
-episode_cache = {}          # chat_id → [ (ep_num, episode_id), … ]
-selected_anime_title = {}   # chat_id → title (so we can refer back to it)
+# Every inline button's callback_data is "<kind>:<random token>", and the token maps
+# to the button's payload here — so handlers do a single lookup instead of parsing
+# indices, each keyboard keeps pointing at its own results, and payloads aren't
+# limited by Telegram's 64-byte callback_data. Bounded + expiring, so stale
+# buttons stop resolving. TTLCache isn't thread-safe and handlers run on several
+# dispatcher workers, so the tokens are split across CALLBACK_SHARDS caches, each
+# behind its own lock (picked by the token's hash), and accessed only through
+# _cache_get / _cache_set.
+CALLBACK_SHARDS = 16   # power of two, so the shard is hash & (CALLBACK_SHARDS - 1)
+_callback_shards = [
+    (TTLCache(maxsize=100_000 // CALLBACK_SHARDS, ttl=3600), threading.Lock())   # callback_data → (kind, payload)
+    for _ in range(CALLBACK_SHARDS)
+]
+
+SESSION_EXPIRED_TEXT = "⌛ This list has expired, please /search again."
+
+def _shard(key):
+    return _callback_shards[hash(key) & (CALLBACK_SHARDS - 1)]
+
+def _cache_get(key, default=None):
+    cache, lock = _shard(key)
+    with lock:
+        return cache.get(key, default)
+
+def _cache_set(key, value):
+    cache, lock = _shard(key)
+    with lock:
+        cache[key] = value
+
+def _make_callback(kind: str, payload) -> str:
+    """Registers `payload` and returns the callback_data for a button of `kind`."""
+    callback_data = f"{kind}:{secrets.token_urlsafe(6)}"
+    _cache_set(callback_data, (kind, payload))
+    return callback_data
+
+def _callback_payload(query):
+    """
+    Returns the payload behind the tapped button, or None (after telling the
+    user to search again) if it has expired.
+    """
+    entry = _cache_get(query.data)
+    if entry is None:
+        try:
+            query.edit_message_text(SESSION_EXPIRED_TEXT)
+        except Exception:
+            pass
+        return None
+    return entry[1]
 
 # ——————————————————————————————————————————————————————————————
 # 4) /start handler
@@ -91,30 +258,16 @@ def start(update: Update, context: CallbackContext):
 
     # Deny access if not in allow‐list
     if user_id not in ALLOWED_USERS:
-        update.message.reply_text(
-            DENIED_MESSAGE,
-            parse_mode="MarkdownV2",
-            disable_web_page_preview=True
-        )
+        if _should_send_denied(user_id):
+            update.message.reply_text(
+                DENIED_MESSAGE,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
         return
 
-    welcome_text = (
-        "🌸 *Hianime Downloader* 🌸\n\n"
-        "🔍 *Find \\& Download Anime Episodes Directly*\n\n"
-        "🎯 *What I Can Do:*\n"
-        "• Search for your favorite anime on [hianimez\\.to](https://hianimez\\.to)\n"
-        "• Download SUB\\-HD2 video as high\\-quality MP4\n"
-        "• Include English subtitles \\(SRT/VTT\\)\n"
-        "• Send everything as a document \\(no quality loss\\)\n\n"
-        "📝 *How to Use:*\n"
-        "1️⃣ `/search <anime name>` \\- Find anime titles\n"
-        "2️⃣ Select the anime from the list of results\n"
-        "3️⃣ Choose an episode to download \\(or tap \\\"Download All\\\"\\)\n"
-        "4️⃣ Receive the high\\-quality MP4 \\+ subtitles automatically\n\n"
-        "📩 *Contact @THe\\_vK\\_3 if any problem or Query* "
-    )
     update.message.reply_text(
-        welcome_text,
+        WELCOME_TEXT,
         parse_mode="MarkdownV2",
         disable_web_page_preview=True
     )
@@ -124,15 +277,15 @@ def start(update: Update, context: CallbackContext):
 # ——————————————————————————————————————————————————————————————
 def search_command(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
 
     # Deny access if not in allow‐list
     if user_id not in ALLOWED_USERS:
-        update.message.reply_text(
-            DENIED_MESSAGE,
-            parse_mode="MarkdownV2",
-            disable_web_page_preview=True
-        )
+        if _should_send_denied(user_id):
+            update.message.reply_text(
+                DENIED_MESSAGE,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
         return
 
     if len(context.args) == 0:
@@ -143,7 +296,6 @@ def search_command(update: Update, context: CallbackContext):
     msg = update.message.reply_text(f"🔍 Searching for “{query_text}”…")
 
     try:
-        from hianimez_scraper import search_anime
         results = search_anime(query_text)
     except Exception as e:
         logger.error(f"Search error: {e}", exc_info=True)
@@ -154,12 +306,11 @@ def search_command(update: Update, context: CallbackContext):
         msg.edit_text(f"No anime found matching “{query_text}.”")
         return
 
-    # Store (title, slug) in search_cache
-    search_cache[chat_id] = [(title, slug) for title, anime_url, slug in results]
-
-    buttons = []
-    for idx, (title, slug) in enumerate(search_cache[chat_id]):
-        buttons.append([InlineKeyboardButton(title, callback_data=f"anime_idx:{idx}")])
+    # Each (title, anime_url, slug) result tuple is the button's payload as-is
+    buttons = [
+        [InlineKeyboardButton(result[0], callback_data=_make_callback("anime", result))]
+        for result in results
+    ]
 
     reply_markup = InlineKeyboardMarkup(buttons)
     try:
@@ -168,21 +319,53 @@ def search_command(update: Update, context: CallbackContext):
         pass
 
 # ——————————————————————————————————————————————————————————————
-# 6) Callback when user taps an anime button (store the title)
+# 6) Callback when user taps an anime button (list its episodes)
 # ——————————————————————————————————————————————————————————————
+# Telegram rejects inline keyboards with more than ~100 buttons, so long series
+# are shown a page at a time.
+EPISODES_PER_PAGE = 30
+
+def _episode_keyboard(title: str, episodes: list, page: int) -> InlineKeyboardMarkup:
+    """
+    One page of “Episode N” buttons, plus ◀ Prev / Next ▶ when there is more than
+    one page, plus “Download All” (which always covers every episode).
+    The (cached, read-only) episode list is referenced by the payloads as-is,
+    without copying it per button. Every payload also carries the anime's
+    title for the “Details Of Anime” header, so an older keyboard still names
+    its own anime.
+    """
+    page_count = (len(episodes) + EPISODES_PER_PAGE - 1) // EPISODES_PER_PAGE
+    page = max(0, min(page, page_count - 1))
+    start = page * EPISODES_PER_PAGE
+
+    buttons = [
+        [InlineKeyboardButton(f"Episode {episode[0]}", callback_data=_make_callback("episode", (title, *episode)))]
+        for episode in episodes[start:start + EPISODES_PER_PAGE]
+    ]
+    if page_count > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀ Prev", callback_data=_make_callback("ep_page", (title, episodes, page - 1))))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{page_count}", callback_data=_make_callback("ep_page", (title, episodes, page))))
+        if page < page_count - 1:
+            nav.append(InlineKeyboardButton("Next ▶", callback_data=_make_callback("ep_page", (title, episodes, page + 1))))
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton("Download All", callback_data=_make_callback("episode_all", (title, episodes)))])
+    return InlineKeyboardMarkup(buttons)
+
 def anime_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
-    chat_id = query.message.chat.id
 
     # Deny access if not in allow‐list
     if user_id not in ALLOWED_USERS:
         query.answer()
-        query.message.reply_text(
-            DENIED_MESSAGE,
-            parse_mode="MarkdownV2",
-            disable_web_page_preview=True
-        )
+        if _should_send_denied(user_id):
+            query.message.reply_text(
+                DENIED_MESSAGE,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
         return
 
     try:
@@ -190,40 +373,16 @@ def anime_callback(update: Update, context: CallbackContext):
     except Exception:
         pass
 
-    data = query.data  # e.g. "anime_idx:3"
-    try:
-        _, idx_str = data.split(":", maxsplit=1)
-        idx = int(idx_str)
-    except Exception:
-        try:
-            query.edit_message_text("❌ Internal error: invalid anime selection.")
-        except Exception:
-            pass
-        return
-
-    anime_list = search_cache.get(chat_id, [])
-    if idx < 0 or idx >= len(anime_list):
-        try:
-            query.edit_message_text("❌ Internal error: anime index out of range.")
-        except Exception:
-            pass
+    payload = _callback_payload(query)
+    if payload is None:
         return
 
-    title, slug = anime_list[idx]
-    selected_anime_title[chat_id] = title
-    anime_url = f"https://hianimez.to/watch/{slug}"
+    title, anime_url, _slug = payload
 
     # Let the user know we’re fetching episodes:
     try:
-        # Escape underscores, dots, parentheses, hyphens before bolding
-        title_escaped = (
-            title
-            .replace("_", "\\_")
-            .replace(".", "\\.")
-            .replace("(", "\\(")
-            .replace(")", "\\)")
-            .replace("-", "\\-")
-        )
+        # Escape MarkdownV2‐reserved characters before bolding
+        title_escaped = title.translate(_MDV2_TABLE)
         query.edit_message_text(
             f"🔍 Fetching episodes for *{title_escaped}*…",
             parse_mode="MarkdownV2"
@@ -232,7 +391,6 @@ def anime_callback(update: Update, context: CallbackContext):
         pass
 
     try:
-        from hianimez_scraper import get_episodes_list
         episodes = get_episodes_list(anime_url)
     except Exception as e:
         logger.error(f"Error fetching episodes: {e}", exc_info=True)
@@ -249,36 +407,29 @@ def anime_callback(update: Update, context: CallbackContext):
             pass
         return
 
-    episode_cache[chat_id] = [(ep_num, ep_id) for ep_num, ep_id in episodes]
-
-    # Build buttons: “Episode 1”, “Episode 2”, … + “Download All”
-    buttons = []
-    for i, (ep_num, ep_id) in enumerate(episode_cache[chat_id]):
-        buttons.append([InlineKeyboardButton(f"Episode {ep_num}", callback_data=f"episode_idx:{i}")])
-    buttons.append([InlineKeyboardButton("Download All", callback_data="episode_all")])
-
-    reply_markup = InlineKeyboardMarkup(buttons)
+    # Build buttons: “Episode 1”, “Episode 2”, … (first page) + “Download All”
+    reply_markup = _episode_keyboard(title, episodes, 0)
     try:
         query.edit_message_text("Select an episode (or Download All):", reply_markup=reply_markup)
     except Exception:
         pass
 
 # ──────────────────────────────────────────────────────────────────────────────
-# 7a) Callback when user taps a single episode button
+# 6a) Callback when user flips to another page of episodes
 # ──────────────────────────────────────────────────────────────────────────────
-def episode_callback(update: Update, context: CallbackContext):
+def episode_page_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
-    chat_id = query.message.chat.id
 
     # Deny access if not in allow‐list
     if user_id not in ALLOWED_USERS:
         query.answer()
-        query.message.reply_text(
-            DENIED_MESSAGE,
-            parse_mode="MarkdownV2",
-            disable_web_page_preview=True
-        )
+        if _should_send_denied(user_id):
+            query.message.reply_text(
+                DENIED_MESSAGE,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
         return
 
     try:
@@ -286,44 +437,51 @@ def episode_callback(update: Update, context: CallbackContext):
     except Exception:
         pass
 
-    data = query.data  # e.g. "episode_idx:5"
+    payload = _callback_payload(query)
+    if payload is None:
+        return
+
+    title, episodes, page = payload
     try:
-        _, idx_str = data.split(":", maxsplit=1)
-        idx = int(idx_str)
+        query.edit_message_reply_markup(reply_markup=_episode_keyboard(title, episodes, page))
     except Exception:
-        try:
-            query.edit_message_text("❌ Invalid episode selection.")
-        except Exception:
-            pass
+        # e.g. "message is not modified" when tapping the current page number
+        pass
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 7a) Callback when user taps a single episode button
+# ──────────────────────────────────────────────────────────────────────────────
+def episode_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    user_id = query.from_user.id
+    chat_id = query.message.chat.id
+
+    # Deny access if not in allow‐list
+    if user_id not in ALLOWED_USERS:
+        query.answer()
+        if _should_send_denied(user_id):
+            query.message.reply_text(
+                DENIED_MESSAGE,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
         return
 
-    ep_list = episode_cache.get(chat_id, [])
-    if idx < 0 or idx >= len(ep_list):
-        try:
-            query.edit_message_text("❌ Episode index out of range.")
-        except Exception:
-            pass
+    try:
+        query.answer()
+    except Exception:
+        pass
+
+    payload = _callback_payload(query)
+    if payload is None:
         return
 
-    ep_num, episode_id = ep_list[idx]
+    anime_name, ep_num, episode_id = payload
 
-    # Fetch the stored anime name (if it exists)
-    anime_name = selected_anime_title.get(chat_id)
     if anime_name:
         # Escape MarkdownV2‐reserved characters in the title
-        safe_name = (
-            anime_name
-            .replace("_", "\\_")
-            .replace(".", "\\.")
-            .replace("(", "\\(")
-            .replace(")", "\\)")
-            .replace("-", "\\-")
-        )
-        details_text = (
-            "🔰 *Details Of Anime* 🔰\n\n"
-            "🎬 *Name:* " + safe_name + "\n"
-            "🔢 *Episode:* " + str(ep_num)
-        )
+        safe_name = anime_name.translate(_MDV2_TABLE)
+        details_text = DETAILS_TEMPLATE.format(name=safe_name, episode=str(ep_num).translate(_MDV2_TABLE))
         # Send as MarkdownV2 so the headings are bold
         try:
             query.edit_message_text(details_text, parse_mode="MarkdownV2")
@@ -341,13 +499,8 @@ def episode_callback(update: Update, context: CallbackContext):
         except Exception:
             pass
 
-    # Start a background thread for (download → upload → subtitle)
-    thread = threading.Thread(
-        target=download_and_send_episode,
-        args=(chat_id, ep_num, episode_id),
-        daemon=True
-    )
-    thread.start()
+    # Queue the (download → upload → subtitle) job on the shared worker pool
+    EXECUTOR.submit(run_episode_job, chat_id, ep_num, episode_id)
     return
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -361,11 +514,12 @@ def episodes_all_callback(update: Update, context: CallbackContext):
     # Deny access if not in allow‐list
     if user_id not in ALLOWED_USERS:
         query.answer()
-        query.message.reply_text(
-            DENIED_MESSAGE,
-            parse_mode="MarkdownV2",
-            disable_web_page_preview=True
-        )
+        if _should_send_denied(user_id):
+            query.message.reply_text(
+                DENIED_MESSAGE,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
         return
 
     try:
@@ -373,7 +527,11 @@ def episodes_all_callback(update: Update, context: CallbackContext):
     except Exception:
         pass
 
-    ep_list = episode_cache.get(chat_id, [])
+    payload = _callback_payload(query)
+    if payload is None:
+        return
+
+    anime_name, ep_list = payload
     if not ep_list:
         try:
             query.edit_message_text("❌ No episodes available to download.")
@@ -381,21 +539,9 @@ def episodes_all_callback(update: Update, context: CallbackContext):
             pass
         return
 
-    anime_name = selected_anime_title.get(chat_id)
     if anime_name:
-        safe_name = (
-            anime_name
-            .replace("_", "\\_")
-            .replace(".", "\\.")
-            .replace("(", "\\(")
-            .replace(")", "\\)")
-            .replace("-", "\\-")
-        )
-        all_text = (
-            "🔰 *Details Of Anime* 🔰\n\n"
-            "🎬 *Name:* " + safe_name + "\n"
-            "🔢 *Episode:* All"
-        )
+        safe_name = anime_name.translate(_MDV2_TABLE)
+        all_text = DETAILS_TEMPLATE.format(name=safe_name, episode="All")
         try:
             query.edit_message_text(all_text, parse_mode="MarkdownV2")
         except Exception:
@@ -411,48 +557,225 @@ def episodes_all_callback(update: Update, context: CallbackContext):
         except Exception:
             pass
 
-    thread = threading.Thread(
-        target=download_and_send_all_episodes,
-        args=(chat_id, ep_list),
-        daemon=True
-    )
-    thread.start()
+    download_and_send_all_episodes(chat_id, ep_list)
     return
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 8) Helper: Telethon upload with real‐time progress → send as “document”
 # ──────────────────────────────────────────────────────────────────────────────
-async def telethon_send_with_progress(chat_id: int, file_path: str, caption: str, status_message_id: int):
+# One Telethon client lives for the whole process on its own event loop, so the
+# MTProto login (DC handshake + auth import) is paid once instead of per file.
+_telethon_loop = asyncio.new_event_loop()
+threading.Thread(target=_telethon_loop.run_forever, name="telethon-loop", daemon=True).start()
+
+_telethon_client = None
+_telethon_start_lock = asyncio.Lock()
+
+async def _get_telethon_client() -> TelegramClient:
     """
-    Uses Telethon (logged in as a Bot via bot_token) to send a single file (up to 2 GB)
-    into `chat_id` as a document. Updates an existing Telegram message (status_message_id)
-    with upload progress. Throttles edits to once every 3 seconds.
+    Returns the shared Telethon client, logging in on first use.
+    Must be awaited on `_telethon_loop`.
     """
-    client = TelegramClient("telethon_bot_session", int(TELETHON_API_ID), TELETHON_API_HASH)
+    global _telethon_client
+    async with _telethon_start_lock:
+        if _telethon_client is None:
+            client = TelegramClient("telethon_bot_session", TELETHON_API_ID, TELETHON_API_HASH)
+            await client.start(bot_token=BOT_TOKEN)
+            _telethon_client = client
+    return _telethon_client
+
+# Large files are uploaded as 512 KB parts with several saveBigFilePart requests in
+# flight; Telethon's own upload_file sends one part at a time.
+UPLOAD_PART_SIZE = 512 * 1024
+UPLOAD_PARALLEL_PARTS = int(os.getenv("UPLOAD_PARALLEL_PARTS", "8"))
+_BIG_FILE_MIN_SIZE = 10 * 1024 * 1024   # Telegram only accepts "big file" uploads above 10 MB
+
+async def _upload_file_parallel(client: TelegramClient, file_path: str, file_name: str, progress_callback=None):
+    """
+    Uploads `file_path` (shown in Telegram as `file_name`) and returns the
+    uploaded-file handle for `send_file`.
+    progress_callback(uploaded_bytes, total_bytes) is called as parts complete.
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size <= _BIG_FILE_MIN_SIZE:
+        return await client.upload_file(
+            file_path, file_name=file_name, part_size_kb=512, progress_callback=progress_callback
+        )
+
+    file_id = generate_random_long()
+    part_count = (file_size + UPLOAD_PART_SIZE - 1) // UPLOAD_PART_SIZE
+    in_flight = asyncio.Semaphore(UPLOAD_PARALLEL_PARTS)
+    loop = asyncio.get_running_loop()
+    uploaded = 0
+
+    with open(file_path, "rb") as f:
+        async def upload_part(index: int):
+            nonlocal uploaded
+            async with in_flight:
+                read = loop.run_in_executor(
+                    None, os.pread, f.fileno(), UPLOAD_PART_SIZE, index * UPLOAD_PART_SIZE
+                )
+                try:
+                    part = await asyncio.shield(read)
+                except asyncio.CancelledError:
+                    # The read can't be interrupted, and it still uses the fd
+                    await asyncio.wait([read])
+                    raise
+                if not await client(SaveBigFilePartRequest(file_id, index, part_count, part)):
+                    raise RuntimeError(f"Telegram rejected part {index} of {file_path}")
+                uploaded += len(part)
+                if progress_callback:
+                    progress_callback(uploaded, file_size)
+
+        tasks = [asyncio.ensure_future(upload_part(i)) for i in range(part_count)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # gather() leaves the other parts running when one fails; stop them
+            # before the file they read from is closed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return InputFileBig(file_id, part_count, file_name)
+
+async def _upload_stream_parallel(client: TelegramClient, chunks, file_name: str, progress_callback=None):
+    """
+    Uploads the bytes of `chunks` (a blocking iterator, e.g. ffmpeg's stdout)
+    while they are still being produced, and returns the uploaded-file handle
+    for `send_file`. The total size isn't known up front, so this is a
+    Telegram “streamed” big-file upload: every part but the last is sent with
+    file_total_parts = -1. Streams that end below the big-file minimum are
+    uploaded in one go instead. progress_callback(uploaded_bytes, None).
+    """
+    loop = asyncio.get_running_loop()
+    source = iter(chunks)
+    buffer = bytearray()
+    eof = False
+
+    def read_part() -> bytes:
+        # Returns the next UPLOAD_PART_SIZE bytes (less for the tail, b"" at the end)
+        nonlocal eof
+        while len(buffer) < UPLOAD_PART_SIZE and not eof:
+            chunk = next(source, None)
+            if chunk is None:
+                eof = True
+            else:
+                buffer.extend(chunk)
+        part = bytes(buffer[:UPLOAD_PART_SIZE])
+        del buffer[:UPLOAD_PART_SIZE]
+        return part
+
+    tasks = []
     try:
-        await client.start(bot_token=BOT_TOKEN)
+        # Telegram rejects big-file uploads under 10 MB, so buffer that much first
+        head = deque()
+        head_size = 0
+        while head_size <= _BIG_FILE_MIN_SIZE:
+            part = await loop.run_in_executor(None, read_part)
+            if not part:
+                return await client.upload_file(
+                    b"".join(head), file_name=file_name, part_size_kb=512, progress_callback=progress_callback
+                )
+            head.append(part)
+            head_size += len(part)
+
+        file_id = generate_random_long()
+        in_flight = asyncio.Semaphore(UPLOAD_PARALLEL_PARTS)
+        uploaded = 0
 
-        total_bytes = os.path.getsize(file_path)
-        start_time = time.time()
+        async def upload_part(index: int, part: bytes, total_parts: int):
+            nonlocal uploaded
+            try:
+                if not await client(SaveBigFilePartRequest(file_id, index, total_parts, part)):
+                    raise RuntimeError(f"Telegram rejected part {index} of {file_name}")
+                uploaded += len(part)
+                if progress_callback:
+                    progress_callback(uploaded, None)
+            finally:
+                in_flight.release()
+
+        # A part is only known to be the last one once the next read comes back
+        # empty, so each part is held back until its successor has been read.
+        index = 0
+        held = head.popleft()
+        while True:
+            nxt = head.popleft() if head else await loop.run_in_executor(None, read_part)
+            if not nxt:
+                break
+            await in_flight.acquire()
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+            tasks.append(asyncio.ensure_future(upload_part(index, held, -1)))
+            index += 1
+            held = nxt
+
+        await in_flight.acquire()
+        tasks.append(asyncio.ensure_future(upload_part(index, held, index + 1)))
+        await asyncio.gather(*tasks)
+        return InputFileBig(file_id, index + 1, file_name)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Stop the producer (for ffmpeg: kill it) if the upload ended early
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            await loop.run_in_executor(None, close)
+
+async def telethon_send_with_progress(chat_id: int, file_path: str, caption: str, status_message_id: int,
+                                     chunks=None, file_name=None, media_progress=None):
+    """
+    Uses the shared Telethon client (logged in as a Bot via bot_token) to send a single
+    file (up to 2 GB) into `chat_id` as a document. Updates an existing Telegram message
+    (status_message_id) with upload progress. Throttles edits to once every 3 seconds.
+    If `chunks` is given, the document's bytes are streamed from it as they are
+    produced and `file_path` only supplies the file name. `file_name` overrides
+    the name shown in Telegram (default: the basename of `file_path`). For streamed
+    uploads, `media_progress()` may return the percentage of the stream produced
+    so far (or None), which is shown since the final size isn't known.
+    Raises if the send failed.
+    """
+    file_name = file_name or os.path.basename(file_path)
+    try:
+        client = await _get_telethon_client()
+        loop = asyncio.get_running_loop()
+
+        start_time = time.monotonic()
         last_upd = 0.0
+        last_percent = -1.0
 
         def progress_callback(uploaded_bytes: int, total_bytes_inner: int):
-            nonlocal last_upd
-            now = time.time()
-            if now - last_upd < 3.0:
+            nonlocal last_upd, last_percent
+            now = time.monotonic()
+            # Edit at most every 3 s, and only once progress has moved by at least 1%
+            if total_bytes_inner:
+                percent = (uploaded_bytes / total_bytes_inner) * 100
+            else:
+                percent = media_progress() if media_progress else None
+            if now - last_upd < 3.0 or (percent is not None and percent - last_percent < 1.0):
                 return
             last_upd = now
+            if percent is not None:
+                last_percent = percent
 
             elapsed = now - start_time
             uploaded_mb = uploaded_bytes / (1024 * 1024)
-            total_mb = total_bytes_inner / (1024 * 1024)
             speed = uploaded_mb / elapsed if elapsed > 0 else 0
-            percent = (uploaded_bytes / total_bytes_inner) * 100 if total_bytes_inner > 0 else 0
-            eta = (
-                (elapsed * (total_bytes_inner - uploaded_bytes) / uploaded_bytes)
-                if uploaded_bytes > 0
-                else None
-            )
+            if total_bytes_inner:
+                total_mb = total_bytes_inner / (1024 * 1024)
+                size_str = f"{uploaded_mb:.2f} MB of {total_mb:.2f} MB"
+                eta = (
+                    (elapsed * (total_bytes_inner - uploaded_bytes) / uploaded_bytes)
+                    if uploaded_bytes > 0
+                    else None
+                )
+            else:
+                # Streamed upload: the final size isn't known until ffmpeg is done,
+                # so progress comes from how far into the episode ffmpeg has got
+                size_str = f"{uploaded_mb:.2f} MB"
+                eta = (elapsed * (100 - percent) / percent) if percent else None
+            percent_str = f"{percent:.1f}%" if percent is not None else "–"
 
             elapsed_str = f"{int(elapsed//60)}m {int(elapsed%60)}s"
             eta_str = (
@@ -464,72 +787,231 @@ async def telethon_send_with_progress(chat_id: int, file_path: str, caption: str
             # Use HTML <b>…</b> so that we don't have to escape all the dots/hyphens in numbers
             text = (
                 "📤 <b>Uploading File</b>\n\n"
-                f"📊Size: {uploaded_mb:.2f} MB of {total_mb:.2f} MB\n"
+                f"📊Size: {size_str}\n"
                 f"⚡️Speed: {speed:.2f} MB/s\n"
                 f"⏱️Time Elapsed: {elapsed_str}\n"
                 f"⏳ETA: {eta_str}\n"
-                f"📈Progress: {percent:.1f}%"
+                f"📈Progress: {percent_str}"
             )
-            try:
-                bot.edit_message_text(
-                    text=text,
-                    chat_id=chat_id,
-                    message_id=status_message_id,
-                    parse_mode="HTML",  # ← HTML bold
-                )
-            except Exception:
-                pass
 
+            def edit_status():
+                try:
+                    bot.edit_message_text(
+                        text=text,
+                        chat_id=chat_id,
+                        message_id=status_message_id,
+                        parse_mode="HTML",  # ← HTML bold
+                    )
+                except Exception:
+                    pass
+
+            # The Bot API call blocks, so keep it off the shared Telethon loop
+            loop.run_in_executor(None, edit_status)
+
+        if chunks is not None:
+            uploaded_file = await _upload_stream_parallel(client, chunks, file_name, progress_callback)
+        else:
+            uploaded_file = await _upload_file_parallel(client, file_path, file_name, progress_callback)
         await client.send_file(
             entity=chat_id,
-            file=file_path,
+            file=uploaded_file,
             caption=caption,
             force_document=True,
-            progress_callback=progress_callback
         )
     except Exception as e:
         logger.error(f"[Telethon] Failed to send {file_path} to chat {chat_id}: {e}", exc_info=True)
-    finally:
-        await client.disconnect()
+        raise
 
-def send_file_via_telethon_with_progress(chat_id: int, file_path: str, caption: str, status_message_id: int):
-    try:
-        asyncio.run(
-            telethon_send_with_progress(
-                chat_id=chat_id,
-                file_path=file_path,
-                caption=caption,
-                status_message_id=status_message_id,
-            )
-        )
-    except Exception as e:
-        logger.error(f"[Telethon sync] Exception while sending {file_path} to chat {chat_id}: {e}", exc_info=True)
+def send_file_via_telethon_with_progress(chat_id: int, file_path: str, caption: str, status_message_id: int,
+                                         chunks=None, file_name=None, media_progress=None):
+    # Errors propagate, so the caller can fall back (e.g. to sending the HLS link)
+    asyncio.run_coroutine_threadsafe(
+        telethon_send_with_progress(
+            chat_id=chat_id,
+            file_path=file_path,
+            caption=caption,
+            status_message_id=status_message_id,
+            chunks=chunks,
+            file_name=file_name,
+            media_progress=media_progress,
+        ),
+        _telethon_loop,
+    ).result()
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 8a) Upload queue: Telethon uploads are drained by a fixed set of uploader threads
+# ──────────────────────────────────────────────────────────────────────────────
+# Bounds concurrent MTProto uploads (avoids flood-waits when “Download All” has many
+# episodes ready at once) and hands them out in the order they were queued.
+_upload_queue = queue.Queue()
+
+def _uploader():
+    while True:
+        job, done = _upload_queue.get()
+        try:
+            send_file_via_telethon_with_progress(**job)
+        except Exception as e:
+            done.set_exception(e)
+        else:
+            done.set_result(None)
+
+for _ in range(MAX_PARALLEL_UPLOADS):
+    threading.Thread(target=_uploader, name="uploader", daemon=True).start()
+
+def queue_telethon_upload(chat_id: int, file_path: str, caption: str, status_message_id: int,
+                          chunks=None, file_name=None, media_progress=None) -> Future:
+    """
+    Queues a Telethon upload; the returned Future resolves once it has been sent.
+    With `chunks`, the bytes are streamed from that iterator (see telethon_send_with_progress).
+    """
+    done = Future()
+    _upload_queue.put((
+        dict(chat_id=chat_id, file_path=file_path, caption=caption, status_message_id=status_message_id,
+             chunks=chunks, file_name=file_name, media_progress=media_progress),
+        done,
+    ))
+    return done
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 8b) Helper: streamed Bot API document upload (no full-file buffering)
+# ──────────────────────────────────────────────────────────────────────────────
+# A session of its own keeps the connection to api.telegram.org alive between
+# uploads, instead of a new TCP + TLS handshake for every episode.
+bot_api_upload_session = requests.Session()
+bot_api_upload_session.mount("https://", HTTPAdapter())
+
+def _send_document_from_chunks(chat_id: int, chunks, caption: str, filename: str):
+    """
+    Sends a document through the Bot API `sendDocument` endpoint from bytes of
+    unknown total length (e.g. ffmpeg's stdout): the multipart body is sent with
+    chunked transfer-encoding as the chunks arrive, never held in memory whole.
+    """
+    boundary = uuid.uuid4().hex
+
+    def body():
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="chat_id"\r\n\r\n{chat_id}\r\n'
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="caption"\r\n\r\n{caption}\r\n'
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="document"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        yield from chunks
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    resp = bot_api_upload_session.post(
+        f"https://api.telegram.org/bot{BOT_TOKEN}/sendDocument",
+        data=body(),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        timeout=(10, 600),
+    )
+    resp.raise_for_status()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 9) Background task for sending a single episode (download → upload → subtitle, with deletions)
 # ──────────────────────────────────────────────────────────────────────────────
-def download_and_send_episode(chat_id: int, ep_num: str, episode_id: str):
-    from hianimez_scraper import extract_episode_stream_and_subtitle
+# Unlinking a multi-GB MP4 can take a while on overlay/network filesystems, so
+# finished files are deleted by a janitor thread instead of the episode job.
+_cleanup_queue = queue.SimpleQueue()
+
+def _janitor():
+    while True:
+        path = _cleanup_queue.get()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+threading.Thread(target=_janitor, name="janitor", daemon=True).start()
+
+def _remove_later(path: str):
+    _cleanup_queue.put(path)
+
+def _edit_status(chat_id: int, message_id: int, text: str, parse_mode=None):
+    try:
+        bot.edit_message_text(
+            text=text,
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode=parse_mode,
+        )
+    except Exception:
+        pass
+
+def _send_subtitle(chat_id: int, ep_num: str, subtitle_download: Future):
+    """
+    Sends the subtitle fetched by `subtitle_download` (a Future resolving to the
+    local .vtt path) as a document. Raises on failure; the local .vtt is
+    removed either way.
+    """
+    local_vtt = subtitle_download.result()
     try:
-        hls_link, subtitle_url = extract_episode_stream_and_subtitle(episode_id)
+        # A .vtt is a few dozen KB: one read() into memory, sent over PTB's pooled connection
+        bot.send_document(
+            chat_id=chat_id,
+            document=Path(local_vtt).read_bytes(),
+            filename=f"Episode {ep_num}.vtt",
+            caption=f"Here is the subtitle for Episode {ep_num}",
+        )
+    finally:
+        _remove_later(local_vtt)
+
+def _send_video_botapi(chat_id: int, ep_num: str, hls_link: str, status_message_id: int) -> bool:
+    """
+    Small episodes: pipes ffmpeg's output straight into the Bot API, with no
+    disk round-trip. Returns False if the episode isn't small enough or the
+    direct send failed, so the caller should fall back to `_send_video_telethon`.
+    """
+    try:
+        estimated_bytes = estimate_hls_size(hls_link)
     except Exception as e:
-        logger.error(f"[Thread] Error extracting Episode {ep_num}: {e}", exc_info=True)
-        bot.send_message(chat_id, f"❌ Failed to extract data for Episode {ep_num}.")
-        return
+        logger.warning(f"[Thread] Could not estimate size of Episode {ep_num}: {e}")
+        return False
+    if estimated_bytes is None or estimated_bytes > BOT_API_DIRECT_MAX_BYTES:
+        return False
 
-    if not hls_link:
-        bot.send_message(chat_id, f"😔 Could not find a SUB-HD2 video stream for Episode {ep_num}.")
-        return
+    _edit_status(chat_id, status_message_id, f"📤 Sending Episode {ep_num}…")
+    last_update = [0.0, -1.0]  # mutable container: [last update timestamp, last percent shown]
+
+    def progress_cb(percent):
+        now = time.monotonic()
+        if now - last_update[0] < 3.0 or percent - last_update[1] < 1.0:
+            return
+        last_update[0] = now
+        last_update[1] = percent
+        _edit_status(chat_id, status_message_id, f"📤 Sending Episode {ep_num}…\nProgress: {percent:.1f}%")
+
+    try:
+        with _ffmpeg_slots:
+            _send_document_from_chunks(
+                chat_id,
+                stream_hls_as_fragmented_mp4(hls_link, progress_callback=progress_cb),
+                caption=f"Episode {ep_num}.mp4",
+                filename=f"Episode {ep_num}.mp4",
+            )
+    except Exception as e:
+        # Includes estimates that turned out too low; the regular path handles any size
+        logger.warning(f"[Thread] Direct send failed for Episode {ep_num}, using download + upload: {e}")
+        return False
+    return True
 
-    #  (b) Step 2: DOWNLOAD MP4 via ffmpeg (with HTML‐powered progress callback)
-    status_download = bot.send_message(chat_id, "📥 Downloading File\nProgress: 0%")
-    last_dl_update = [0.0]  # mutable container to track last update timestamp
+def _download_episode_mp4(chat_id: int, ep_num: str, hls_link: str, status_message_id: int) -> str:
+    """
+    Downloads the episode to an MP4 under videos_cache, reporting progress in
+    the status message, and returns its path. Raises if ffmpeg fails.
+    """
+    _edit_status(chat_id, status_message_id, f"📥 Downloading Episode {ep_num}...\nProgress: 0%")
+    last_dl_update = [0.0, -1.0]  # mutable container: [last update timestamp, last percent shown]
 
     def download_progress_cb(downloaded_mb, total_duration_s, percent, speed_mb_s, elapsed_s, eta_s):
-        now = time.time()
-        if now - last_dl_update[0] < 3.0:
+        now = time.monotonic()
+        # Edit at most every 3 s, and only once progress has moved by at least 1% (100% always shows)
+        if now - last_dl_update[0] < 3.0 or (percent < 100 and percent - last_dl_update[1] < 1.0):
             return
         last_dl_update[0] = now
+        last_dl_update[1] = percent
 
         elapsed_str = f"{int(elapsed_s//60)}m {int(elapsed_s%60)}s"
         eta_str = (
@@ -539,332 +1021,244 @@ def download_and_send_episode(chat_id: int, ep_num: str, episode_id: str):
         )
 
         text = (
-            "📥 <b>Downloading File</b>\n\n"
+            f"📥 <b>Downloading Episode {ep_num}</b>\n\n"
             f"📊Size: {downloaded_mb:.2f} MB\n"
             f"⚡️Speed: {speed_mb_s:.2f} MB/s\n"
             f"⏱️Time Elapsed: {elapsed_str}\n"
             f"⏳ETA: {eta_str}\n"
             f"📈Progress: {percent:.1f}%"
         )
-        try:
-            bot.edit_message_text(
-                text=text,
-                chat_id=chat_id,
-                message_id=status_download.message_id,
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
+        _edit_status(chat_id, status_message_id, text, parse_mode="HTML")
 
-    try:
-        raw_mp4 = download_and_rename_video(
+    with _ffmpeg_slots:
+        return download_and_rename_video(
             hls_link,
             ep_num,
             cache_dir="videos_cache",
             progress_callback=download_progress_cb
         )
-    except Exception as e:
-        logger.error(f"[Thread] Error downloading video (Episode {ep_num}): {e}", exc_info=True)
-        # If ffmpeg fails, delete the “Downloading File” status and send fallback
-        try:
-            bot.delete_message(chat_id=chat_id, message_id=status_download.message_id)
-        except Exception:
-            pass
 
-        bot.send_message(
-            chat_id,
-            f"⚠️ Failed to convert Episode {ep_num} to MP4. Here’s the HLS link instead:\n\n{hls_link}"
-        )
-        if subtitle_url:
-            try:
-                local_vtt = download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache")
-                status_sub = bot.send_message(chat_id, f"✅ Subtitle downloaded as “Episode {ep_num}.vtt”.")
-                bot.send_document(
-                    chat_id=chat_id,
-                    document=InputFile(open(local_vtt, "rb"), filename=f"Episode {ep_num}.vtt"),
-                    caption=f"Here is the subtitle for Episode {ep_num}"
-                )
-                os.remove(local_vtt)
-                try:
-                    bot.delete_message(chat_id=chat_id, message_id=status_sub.message_id)
-                except Exception:
-                    pass
-            except Exception as se:
-                logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {se}", exc_info=True)
-                bot.send_message(chat_id, f"⚠️ Could not download/send subtitle for Episode {ep_num}.")
-        return
+def _send_video_telethon(chat_id: int, ep_num: str, hls_link: str, status_message_id: int, raw_mp4: str = None):
+    """
+    Sends the episode via Telethon, reporting progress in the status message.
+    ffmpeg's output is first streamed straight into the upload; if that fails,
+    the episode is downloaded to an MP4 on disk and uploaded from there.
+    `raw_mp4`, if given, is an MP4 already downloaded by _download_episode_mp4
+    and is uploaded as is.
+    Returns None once the video is sent, or the user-facing fallback text (with
+    the HLS link) if it couldn't be.
+    """
+    if raw_mp4 is None:
+        if _stream_video_telethon(chat_id, ep_num, hls_link, status_message_id):
+            return None
 
-    # Delete the “Downloading File” status message (100% download done)
-    try:
-        bot.delete_message(chat_id=chat_id, message_id=status_download.message_id)
-    except Exception:
-        pass
+        #  (b) Step 2: DOWNLOAD MP4 via ffmpeg (with HTML‐powered progress callback)
+        try:
+            raw_mp4 = _download_episode_mp4(chat_id, ep_num, hls_link, status_message_id)
+        except Exception as e:
+            logger.error(f"[Thread] Error downloading video (Episode {ep_num}): {e}", exc_info=True)
+            return f"⚠️ Failed to convert Episode {ep_num} to MP4. Here’s the HLS link instead:\n\n{hls_link}"
 
     # (c) Step 3: UPLOAD MP4 via Telethon (with HTML‐powered progress callback)
-    status_upload = bot.send_message(chat_id, "📤 Uploading File\nProgress: 0%")
+    _edit_status(chat_id, status_message_id, f"📤 Episode {ep_num} queued for upload…")
     try:
-        send_file_via_telethon_with_progress(
+        queue_telethon_upload(
             chat_id=chat_id,
             file_path=raw_mp4,
+            file_name=f"Episode {ep_num}.mp4",
             caption=f"Episode {ep_num}.mp4",
-            status_message_id=status_upload.message_id
-        )
+            status_message_id=status_message_id
+        ).result()
     except Exception as e:
         logger.error(f"[Thread] Telethon upload failed for Episode {ep_num}: {e}", exc_info=True)
-        # Delete “Uploading File” status, then fallback to HLS link + subtitle
-        try:
-            bot.delete_message(chat_id=chat_id, message_id=status_upload.message_id)
-        except Exception:
-            pass
-
-        bot.send_message(chat_id, f"⚠️ Could not send Episode {ep_num} via Telethon. Here’s the HLS link:\n\n{hls_link}")
-        try:
-            os.remove(raw_mp4)
-        except OSError:
-            pass
-
-        if subtitle_url:
-            try:
-                local_vtt = download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache")
-                status_sub = bot.send_message(chat_id, f"✅ Subtitle downloaded as “Episode {ep_num}.vtt.”")
-                bot.send_document(
-                    chat_id=chat_id,
-                    document=InputFile(open(local_vtt, "rb"), filename=f"Episode {ep_num}.vtt"),
-                    caption=f"Here is the subtitle for Episode {ep_num}"
-                )
-                os.remove(local_vtt)
-                try:
-                    bot.delete_message(chat_id=chat_id, message_id=status_sub.message_id)
-                except Exception:
-                    pass
-            except Exception as se:
-                logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {se}", exc_info=True)
-                bot.send_message(chat_id, f"⚠️ Could not download/send subtitle for Episode {ep_num}.")
-        return
+        return f"⚠️ Could not send Episode {ep_num} via Telethon. Here’s the HLS link:\n\n{hls_link}"
     finally:
-        # Always try to clean up the raw MP4 from disk once Telethon is done (or on error)
-        try:
-            os.remove(raw_mp4)
-        except OSError:
-            pass
+        # Always clean up the raw MP4 from disk once Telethon is done (or on error)
+        _remove_later(raw_mp4)
+    return None
 
-    # Delete the “Uploading File” status message (100% upload done)
-    try:
-        bot.delete_message(chat_id=chat_id, message_id=status_upload.message_id)
-    except Exception:
-        pass
+def _stream_video_telethon(chat_id: int, ep_num: str, hls_link: str, status_message_id: int) -> bool:
+    """
+    Streams ffmpeg's output straight into a Telethon upload, without an MP4 on
+    disk. Returns False if that failed and the caller should fall back.
+    """
+    media_percent = [None]  # how far into the episode ffmpeg has got, for the upload progress
 
-    # (d) Step 4: Send subtitle via Bot API (small file)
-    if not subtitle_url:
-        bot.send_message(chat_id, "❗ No English subtitle (.vtt) found.")
-        return
+    def on_media_progress(percent):
+        media_percent[0] = percent
 
-    try:
-        local_vtt = download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache")
-    except Exception as e:
-        logger.error(f"[Thread] Error downloading subtitle (Episode {ep_num}): {e}", exc_info=True)
-        bot.send_message(chat_id, f"⚠️ Found a subtitle URL but failed to download for Episode {ep_num}.")
-        return
+    def episode_stream():
+        # Only takes an ffmpeg slot once the uploader starts pulling bytes
+        with _ffmpeg_slots:
+            yield from stream_hls_as_fragmented_mp4(hls_link, progress_callback=on_media_progress)
 
-    status_sub = bot.send_message(chat_id, f"✅ Subtitle downloaded as “Episode {ep_num}.vtt.”")
+    _edit_status(chat_id, status_message_id, f"📤 Episode {ep_num} queued for upload…")
     try:
-        bot.send_document(
+        queue_telethon_upload(
             chat_id=chat_id,
-            document=InputFile(open(local_vtt, "rb"), filename=f"Episode {ep_num}.vtt"),
-            caption=f"Here is the subtitle for Episode {ep_num}"
-        )
+            file_path=f"Episode {ep_num}.mp4",
+            caption=f"Episode {ep_num}.mp4",
+            status_message_id=status_message_id,
+            chunks=episode_stream(),
+            media_progress=lambda: media_percent[0],
+        ).result()
+        return True
     except Exception as e:
-        logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {e}", exc_info=True)
-        bot.send_message(chat_id, f"⚠️ Could not send subtitle for Episode {ep_num}.")
-    finally:
-        try:
-            os.remove(local_vtt)
-        except OSError:
-            pass
+        logger.warning(f"[Thread] Streamed upload failed for Episode {ep_num}, retrying via a local MP4: {e}")
+        return False
 
-    # Delete the subtitle‐status message after sending
-    try:
-        bot.delete_message(chat_id=chat_id, message_id=status_sub.message_id)
-    except Exception:
-        pass
-
-# ──────────────────────────────────────────────────────────────────────────────
-# 10) Background task for “Download All” episodes (download→upload→subtitle)
-# ──────────────────────────────────────────────────────────────────────────────
-def download_and_send_all_episodes(chat_id: int, ep_list: list):
-    from hianimez_scraper import extract_episode_stream_and_subtitle
+def download_and_send_episode(chat_id: int, ep_num: str, episode_id: str, extracted=None, previous_sent=None):
+    """
+    `extracted` may be a Future already resolving to (hls_link, subtitle_url),
+    as prefetched by “Download All”; otherwise the lookup happens here.
 
-    for ep_num, episode_id in ep_list:
-        try:
-            hls_link, subtitle_url = extract_episode_stream_and_subtitle(episode_id)
-        except Exception as e:
-            logger.error(f"[Thread] Error extracting Episode {ep_num}: {e}", exc_info=True)
-            bot.send_message(chat_id, f"❌ Failed to extract data for Episode {ep_num}. Skipping.")
-            continue
+    `previous_sent`, set by “Download All”, is a threading.Event for the episode
+    before this one in the batch. Nothing is sent to the chat until it is set,
+    so a batch arrives in episode order; meanwhile the episode is downloaded to
+    disk so it's ready to upload as soon as its turn comes.
 
-        if not hls_link:
-            bot.send_message(chat_id, f"😔 Episode {ep_num}: No SUB-HD2 stream found. Skipping.")
-            continue
+    All progress for the episode goes into a single status message that is
+    edited in place, rather than a new message per step.
+    """
+    status_msg = bot.send_message(chat_id, f"⏳ Episode {ep_num}: queued…")
+    status_id = status_msg.message_id
 
-        # (b) Download raw MP4
-        status_download = bot.send_message(chat_id, f"📥 Downloading Episode {ep_num}...\nProgress: 0%")
-        last_dl_update = [0.0]
+    try:
+        if extracted is not None:
+            hls_link, subtitle_url = extracted.result()
+        else:
+            hls_link, subtitle_url = extract_episode_stream_and_subtitle(episode_id)
+    except Exception as e:
+        logger.error(f"[Thread] Error extracting Episode {ep_num}: {e}", exc_info=True)
+        _edit_status(chat_id, status_id, f"❌ Failed to extract data for Episode {ep_num}.")
+        return
 
-        def download_progress_cb(downloaded_mb, total_duration_s, percent, speed_mb_s, elapsed_s, eta_s):
-            now = time.time()
-            if now - last_dl_update[0] < 3.0:
-                return
-            last_dl_update[0] = now
+    if not hls_link:
+        _edit_status(chat_id, status_id, f"😔 Could not find a SUB-HD2 video stream for Episode {ep_num}.")
+        return
 
-            elapsed_str = f"{int(elapsed_s//60)}m {int(elapsed_s%60)}s"
-            eta_str = (
-                f"{int(eta_s//60)}m {int(eta_s%60)}s"
-                if (eta_s is not None and eta_s >= 0)
-                else "–"
-            )
-            text = (
-                f"📥 <b>Downloading Episode {ep_num}</b>\n"
-                f"📊Size: {downloaded_mb:.2f} MB\n"
-                f"⚡️Speed: {speed_mb_s:.2f} MB/s\n"
-                f"⏱️Time Elapsed: {elapsed_str}\n"
-                f"⏳ETA: {eta_str}\n"
-                f"📈Progress: {percent:.1f}%"
-            )
-            try:
-                bot.edit_message_text(text, chat_id=chat_id, message_id=status_download.message_id, parse_mode="HTML")
-            except Exception:
-                pass
+    # The subtitle is tiny and independent of the video, so fetch it while the video is sent
+    subtitle_download = None
+    if subtitle_url:
+        subtitle_download = _extract_pool.submit(
+            download_and_rename_subtitle, subtitle_url, ep_num, cache_dir="subtitles_cache"
+        )
 
+    raw_mp4 = None
+    if previous_sent is not None and not previous_sent.is_set():
         try:
-            raw_mp4 = download_and_rename_video(
-                hls_link,
-                ep_num,
-                cache_dir="videos_cache",
-                progress_callback=download_progress_cb
-            )
+            raw_mp4 = _download_episode_mp4(chat_id, ep_num, hls_link, status_id)
         except Exception as e:
-            logger.error(f"[Thread] Error downloading Episode {ep_num}: {e}", exc_info=True)
-            try:
-                bot.delete_message(chat_id=chat_id, message_id=status_download.message_id)
-            except Exception:
-                pass
-
-            # Fallback: send HLS link + subtitle
-            bot.send_message(
-                chat_id,
-                f"⚠️ Could not convert Episode {ep_num} to MP4. Here’s the HLS link:\n\n{hls_link}"
-            )
-            if subtitle_url:
+            # Try again the usual way once it's this episode's turn
+            logger.warning(f"[Thread] Early download of Episode {ep_num} failed: {e}")
+        _edit_status(chat_id, status_id, f"⏳ Episode {ep_num}: waiting for the previous episode to be sent…")
+        previous_sent.wait()
+
+    if raw_mp4 is not None or not _send_video_botapi(chat_id, ep_num, hls_link, status_id):
+        fallback_text = _send_video_telethon(chat_id, ep_num, hls_link, status_id, raw_mp4=raw_mp4)
+        if fallback_text is not None:
+            # Leave the HLS link in the status message and still send the subtitle
+            _edit_status(chat_id, status_id, fallback_text)
+            if subtitle_download is not None:
                 try:
-                    local_vtt = download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache")
-                    status_sub = bot.send_message(chat_id, f"✅ Subtitle downloaded as “Episode {ep_num}.vtt.”")
-                    bot.send_document(
-                        chat_id=chat_id,
-                        document=InputFile(open(local_vtt, "rb"), filename=f"Episode {ep_num}.vtt"),
-                        caption=f"Here is the subtitle for Episode {ep_num}"
+                    _send_subtitle(chat_id, ep_num, subtitle_download)
+                except Exception as e:
+                    logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {e}", exc_info=True)
+                    _edit_status(
+                        chat_id, status_id,
+                        f"{fallback_text}\n\n⚠️ Could not download/send subtitle for Episode {ep_num}."
                     )
-                    os.remove(local_vtt)
-                    try:
-                        bot.delete_message(chat_id=chat_id, message_id=status_sub.message_id)
-                    except Exception:
-                        pass
-                except Exception as se:
-                    logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {se}", exc_info=True)
-                    bot.send_message(chat_id, f"⚠️ Could not send subtitle for Episode {ep_num}.")
-            continue
-
-        # Delete the “Downloading Episode…” status message (100% download done)
-        try:
-            bot.delete_message(chat_id=chat_id, message_id=status_download.message_id)
-        except Exception:
-            pass
-
-        # (c) Upload via Telethon
-        status_upload = bot.send_message(chat_id, f"📤 Uploading Episode {ep_num}...\nProgress: 0%")
-        try:
-            send_file_via_telethon_with_progress(
-                chat_id=chat_id,
-                file_path=raw_mp4,
-                caption=f"Episode {ep_num}.mp4",
-                status_message_id=status_upload.message_id
-            )
-        except Exception as e:
-            logger.error(f"[Thread] Telethon upload failed for Episode {ep_num}: {e}", exc_info=True)
-            try:
-                bot.delete_message(chat_id=chat_id, message_id=status_upload.message_id)
-            except Exception:
-                pass
+            return
 
-            # Fallback: send HLS link + subtitle
-            bot.send_message(chat_id, f"⚠️ Could not send Episode {ep_num} via Telethon. Here’s the HLS link:\n\n{hls_link}")
-            try:
-                os.remove(raw_mp4)
-            except OSError:
-                pass
-            if subtitle_url:
-                try:
-                    local_vtt = download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache")
-                    status_sub = bot.send_message(chat_id, f"✅ Subtitle downloaded as “Episode {ep_num}.vtt.”")
-                    bot.send_document(
-                        chat_id=chat_id,
-                        document=InputFile(open(local_vtt, "rb"), filename=f"Episode {ep_num}.vtt"),
-                        caption=f"Here is the subtitle for Episode {ep_num}"
-                    )
-                    os.remove(local_vtt)
-                    try:
-                        bot.delete_message(chat_id=chat_id, message_id=status_sub.message_id)
-                    except Exception:
-                        pass
-                except Exception as se:
-                    logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {se}", exc_info=True)
-                    bot.send_message(chat_id, f"⚠️ Could not send subtitle for Episode {ep_num}.")
-            continue
-        finally:
-            # Clean up raw MP4
-            try:
-                os.remove(raw_mp4)
-            except OSError:
-                pass
+    # (d) Step 4: Send subtitle via Bot API (small file)
+    if subtitle_download is None:
+        _edit_status(chat_id, status_id, f"❗ No English subtitle (.vtt) found for Episode {ep_num}.")
+        return
 
-        # Delete the “Uploading Episode…” status message
-        try:
-            bot.delete_message(chat_id=chat_id, message_id=status_upload.message_id)
-        except Exception:
-            pass
+    try:
+        _send_subtitle(chat_id, ep_num, subtitle_download)
+    except Exception as e:
+        logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {e}", exc_info=True)
+        _edit_status(chat_id, status_id, f"⚠️ Could not download/send subtitle for Episode {ep_num}.")
+        return
 
-        # (d) Send subtitle
-        if not subtitle_url:
-            bot.send_message(chat_id, f"❗ No English subtitle found for Episode {ep_num}.")
-            continue
+    # Everything was delivered; the status message has nothing left to say
+    try:
+        bot.delete_message(chat_id=chat_id, message_id=status_id)
+    except Exception:
+        pass
 
-        try:
-            local_vtt = download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache")
-        except Exception as e:
-            logger.error(f"[Thread] Error downloading subtitle (Episode {ep_num}): {e}", exc_info=True)
-            bot.send_message(chat_id, f"⚠️ Could not download subtitle for Episode {ep_num}.")
-            continue
+def run_episode_job(chat_id: int, ep_num: str, episode_id: str, **kwargs):
+    """
+    download_and_send_episode as submitted to EXECUTOR: anything it raises is
+    logged here, since nobody ever reads the job's Future.
+    """
+    try:
+        download_and_send_episode(chat_id, ep_num, episode_id, **kwargs)
+    except Exception as e:
+        logger.error(f"[Thread] Unexpected error for Episode {ep_num}: {e}", exc_info=True)
 
-        status_sub = bot.send_message(chat_id, f"✅ Subtitle downloaded as “Episode {ep_num}.vtt.”")
+# ──────────────────────────────────────────────────────────────────────────────
+# 10) Background task for “Download All” episodes (download→upload→subtitle)
+# ──────────────────────────────────────────────────────────────────────────────
+def download_and_send_all_episodes(chat_id: int, ep_list: list):
+    """
+    Queues every episode on EXECUTOR, keeping at most ALL_EP_CONCURRENCY of
+    this batch's episodes in flight so one episode's ffmpeg download overlaps
+    with another's upload; each finished episode queues the next one. Each
+    episode waits for the one before it to be sent before sending itself, so
+    the batch arrives in episode order. Returns immediately. Stream and
+    subtitle URLs are looked up EXTRACT_PREFETCH episodes ahead of the jobs,
+    so the API round-trip is already done when an episode's turn comes.
+    """
+    extracted = [None] * len(ep_list)
+    sent = [threading.Event() for _ in ep_list]  # set once an episode is done with the chat, sent or not
+    next_to_extract = 0
+    next_to_run = 0
+    lock = threading.Lock()
+
+    def prefetch(upto: int):
+        # Called with `lock` held
+        nonlocal next_to_extract
+        while next_to_extract < min(upto, len(ep_list)):
+            _, ep_id = ep_list[next_to_extract]
+            extracted[next_to_extract] = _extract_pool.submit(extract_episode_stream_and_subtitle, ep_id)
+            next_to_extract += 1
+
+    def run_one(idx: int):
+        ep_num, episode_id = ep_list[idx]
         try:
-            bot.send_document(
-                chat_id=chat_id,
-                document=InputFile(open(local_vtt, "rb"), filename=f"Episode {ep_num}.vtt"),
-                caption=f"Here is the subtitle for Episode {ep_num}"
+            run_episode_job(
+                chat_id, ep_num, episode_id,
+                extracted=extracted[idx],
+                previous_sent=sent[idx - 1] if idx else None,
             )
-        except Exception as e:
-            logger.error(f"[Thread] Error sending subtitle (Episode {ep_num}): {e}", exc_info=True)
-            bot.send_message(chat_id, f"⚠️ Could not send subtitle for Episode {ep_num}.")
         finally:
-            try:
-                os.remove(local_vtt)
-            except OSError:
-                pass
+            # An episode that gave up early (e.g. no stream found) never waited
+            # for its turn, so wait here before handing over: the next one must
+            # not overtake an episode that is still being sent. Always hand
+            # over, or every later episode would wait forever.
+            if idx:
+                sent[idx - 1].wait()
+            sent[idx].set()
+
+    def start_next(_finished=None):
+        nonlocal next_to_run
+        # Episodes block an EXECUTOR worker while waiting for their turn, so they
+        # must be submitted in index order: an episode is then never queued
+        # behind a later one that is waiting for it.
+        with lock:
+            if next_to_run >= len(ep_list):
+                return
+            idx = next_to_run
+            next_to_run += 1
+            prefetch(idx + 1 + EXTRACT_PREFETCH)
+            job = EXECUTOR.submit(run_one, idx)
+        # Outside the lock: the callback runs right here if the job already finished
+        job.add_done_callback(start_next)
 
-        # Delete the subtitle‐status message
-        try:
-            bot.delete_message(chat_id=chat_id, message_id=status_sub.message_id)
-        except Exception:
-            pass
+    for _ in range(min(ALL_EP_CONCURRENCY, len(ep_list))):
+        start_next()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 11) Error handler
@@ -880,42 +1274,100 @@ def error_handler(update: object, context: CallbackContext):
 # ──────────────────────────────────────────────────────────────────────────────
 # 12) Register handlers with the dispatcher
 # ──────────────────────────────────────────────────────────────────────────────
+# All inline buttons go through one CallbackQueryHandler: the "<kind>:" prefix of
+# the callback_data picks the handler with a dict lookup, instead of each
+# registered handler matching its own regex against every button press.
+CALLBACK_HANDLERS = {
+    "anime": anime_callback,
+    "episode": episode_callback,
+    "episode_all": episodes_all_callback,
+    "ep_page": episode_page_callback,
+}
+
+def callback_router(update: Update, context: CallbackContext):
+    query = update.callback_query
+    kind, _, _ = (query.data or "").partition(":")
+    handler = CALLBACK_HANDLERS.get(kind)
+    if handler is None:
+        # Buttons from an older version of the bot
+        try:
+            query.answer()
+            query.edit_message_text(SESSION_EXPIRED_TEXT)
+        except Exception:
+            pass
+        return
+    handler(update, context)
+
 dispatcher.add_handler(CommandHandler("start", start))
 dispatcher.add_handler(CommandHandler("search", search_command))
-dispatcher.add_handler(CallbackQueryHandler(anime_callback, pattern=r"^anime_idx:"))
-dispatcher.add_handler(CallbackQueryHandler(episode_callback, pattern=r"^episode_idx:"))
-dispatcher.add_handler(CallbackQueryHandler(episodes_all_callback, pattern=r"^episode_all$"))
+dispatcher.add_handler(CallbackQueryHandler(callback_router))
 dispatcher.add_error_handler(error_handler)
 
 # ──────────────────────────────────────────────────────────────────────────────
-# 13) Flask app for webhook + health check
+# 13) ASGI app (FastAPI on uvicorn) for webhook + health check
 # ──────────────────────────────────────────────────────────────────────────────
-app = Flask(__name__)
+app = FastAPI()
 
-@app.route("/webhook", methods=["POST"])
-def webhook_handler():
-    data = request.get_json(force=True)
+# PTB v13 handlers are blocking, so they run on this pool rather than the event
+# loop. The webhook doesn't wait for them: Telegram gets its 200 right away and
+# never retries an update because a handler (a search, say) was slow.
+_update_executor = ThreadPoolExecutor(max_workers=PTB_WORKERS, thread_name_prefix="update")
+
+@app.post("/webhook", response_class=PlainTextResponse)
+async def webhook_handler(req: FastAPIRequest):
+    # orjson (C) instead of the stdlib json module Starlette's req.json() uses
+    data = orjson.loads(await req.body())
     update = Update.de_json(data, bot)
-    dispatcher.process_update(update)
-    return "OK", 200
+    # process_update reports handler exceptions to error_handler itself
+    _update_executor.submit(dispatcher.process_update, update)
+    return "OK"
+
+@app.get("/", response_class=PlainTextResponse)
+async def health_check():
+    return "OK"
 
-@app.route("/", methods=["GET"])
-def health_check():
-    return "OK", 200
+# Idle keep-alive connections get closed by Telegram/the proxy after a few
+# minutes; touching them periodically keeps the first webhook after a quiet
+# spell from paying DNS + TCP + TLS again.
+KEEPALIVE_INTERVAL = 240  # seconds
+
+def _keepalive():
+    while True:
+        try:
+            bot.get_me()
+        except Exception as e:
+            logger.warning(f"Keep-alive get_me failed: {e}")
+        warm_connection()
+        time.sleep(KEEPALIVE_INTERVAL)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 14) On startup, set Telegram webhook to <KOYEB_APP_URL>/webhook
 # ──────────────────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
     webhook_url = f"{KOYEB_APP_URL}/webhook"
+    # Only commands and button presses are handled; don't have Telegram POST anything else
+    allowed_updates = ["message", "callback_query"]
     try:
-        bot.set_webhook(webhook_url)
-        logger.info(f"Successfully set webhook to {webhook_url}")
+        current = bot.get_webhook_info()
+        if current.url != webhook_url or sorted(current.allowed_updates or []) != sorted(allowed_updates):
+            bot.set_webhook(webhook_url, allowed_updates=allowed_updates)
+            logger.info(f"Successfully set webhook to {webhook_url}")
+        else:
+            logger.info(f"Webhook already set to {webhook_url}")
     except Exception as ex:
         logger.error(f"Failed to set webhook: {ex}", exc_info=True)
         raise
 
+    # Log the shared Telethon client in now, so the first upload doesn't pay for it
+    try:
+        asyncio.run_coroutine_threadsafe(_get_telethon_client(), _telethon_loop).result()
+        logger.info("Telethon client connected")
+    except Exception as ex:
+        logger.error(f"Failed to start Telethon client (will retry on first upload): {ex}", exc_info=True)
+
     os.makedirs("subtitles_cache", exist_ok=True)
     os.makedirs("videos_cache", exist_ok=True)
-    logger.info("Starting Flask server on port 8080…")
-    app.run(host="0.0.0.0", port=8080)
+    threading.Thread(target=_keepalive, name="keepalive", daemon=True).start()
+    logger.info("Starting uvicorn server on port 8080…")
+    # A single worker on purpose: the caches and the Telethon session live in this process.
+    uvicorn.run(app, host="0.0.0.0", port=8080, loop="uvloop", http="httptools")
@@ -1,8 +1,12 @@
 # hianimez_scraper.py
 
 import os
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+from cachetools.func import ttl_cache
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +17,25 @@ ANIWATCH_API_BASE = os.getenv(
     "http://localhost:4000/api/v2/hianime"
 )
 
+# One keep-alive session for every AniWatch call, so lookups (including the
+# prefetched extractions of a “Download All” batch) reuse warm connections
+# instead of paying DNS + TCP (+ TLS) on each request. Gateway errors from the
+# API host are retried a few times before a lookup is reported as failed.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    pool_block=False,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504)),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Search results and episode lists barely change, so popular titles are served
+# from memory for a while instead of being re-fetched for every viewer.
+LOOKUP_CACHE_SIZE = 1024
+LOOKUP_CACHE_TTL = 600  # seconds
+
 
 def search_anime(query: str):
     """
@@ -21,11 +44,20 @@ def search_anime(query: str):
     where:
       - animeId is the slug (e.g. "raven-of-the-inner-palace-18168")
       - anime_url = "https://hianimez.to/watch/{animeId}"
+
+    Results are cached for LOOKUP_CACHE_TTL seconds per query, ignoring case and
+    extra whitespace ("Naruto " and "naruto" share an entry); treat the
+    returned list as read-only.
     """
+    return _search_anime_cached(re.sub(r"\s+", " ", query.strip().lower()))
+
+
+@ttl_cache(maxsize=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL)
+def _search_anime_cached(query: str):
     url = f"{ANIWATCH_API_BASE}/search"
     params = {"q": query, "page": 1}
 
-    resp = requests.get(url, params=params, timeout=10)
+    resp = SESSION.get(url, params=params, timeout=10)
     resp.raise_for_status()
 
     full_json = resp.json()
@@ -54,6 +86,7 @@ def search_anime(query: str):
     return results
 
 
+@ttl_cache(maxsize=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL)
 def get_episodes_list(anime_url: str):
     """
     Given a HiAnime page URL (e.g. "https://hianimez.to/watch/raven-of-the-inner-palace-18168"),
@@ -64,6 +97,8 @@ def get_episodes_list(anime_url: str):
       [ ("1", "raven-of-the-inner-palace-18168?ep=1"),
         ("2", "raven-of-the-inner-palace-18168?ep=2"),
         … ]
+
+    Cached like search_anime; treat the returned list as read-only.
     """
     try:
         slug = anime_url.rstrip("/").split("/")[-1]
@@ -71,7 +106,7 @@ def get_episodes_list(anime_url: str):
         return []
 
     ep_list_url = f"{ANIWATCH_API_BASE}/anime/{slug}/episodes"
-    resp = requests.get(ep_list_url, timeout=10)
+    resp = SESSION.get(ep_list_url, timeout=10)
 
     # If the anime has no “/anime/{slug}/episodes” list (e.g. a one‐shot), the API may return 404.
     # In that case, we treat it as a single‐episode fallback:
@@ -118,7 +153,7 @@ def extract_episode_stream_and_subtitle(episode_id: str):
         "category":       "sub"
     }
 
-    resp = requests.get(url, params=params, timeout=10)
+    resp = SESSION.get(url, params=params, timeout=10)
     resp.raise_for_status()
 
     data = resp.json().get("data", {})
@@ -157,3 +192,14 @@ def extract_episode_stream_and_subtitle(episode_id: str):
             break
 
     return hls_link, subtitle_url
+
+
+def warm_connection():
+    """
+    Touches ANIWATCH_API_BASE through SESSION so a pooled connection is open
+    before the next real lookup. Any response (even a 404) will do.
+    """
+    try:
+        SESSION.head(ANIWATCH_API_BASE, timeout=10)
+    except requests.RequestException as e:
+        logger.warning("Could not reach AniWatch API at %s: %s", ANIWATCH_API_BASE, e)
@@ -1,39 +1,150 @@
+import io
 import os
+import logging
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import m3u8
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Cap ffmpeg's threads and run it at a lower priority so the webhook and upload
+# threads stay responsive while episodes are being downloaded on a small VM.
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+FFMPEG_NICENESS = 10
+
+# How many HLS segments are fetched at once for a single episode.
+HLS_FETCH_WORKERS = int(os.getenv("HLS_FETCH_WORKERS", "8"))
+
+# Shared keep-alive session for every subtitle, playlist and segment request, so a
+# “Download All” batch reuses its connections to the CDN instead of handshaking
+# once per episode. DL_POOL is how many connections are kept open per host; it
+# should cover HLS_FETCH_WORKERS for each episode downloading at once.
+DL_POOL = int(os.getenv("DL_POOL", "32"))
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=DL_POOL,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504)),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 
-def download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache"):
+def _popen_ffmpeg(cmd, **kwargs):
     """
-    Downloads subtitle from subtitle_url, saves as "Episode {ep_num}.vtt" in cache_dir.
-    Returns the local file path.
+    Starts ffmpeg and lowers its priority to FFMPEG_NICENESS. Done from the
+    parent after the fact: a preexec_fn isn't safe in this multi-threaded
+    process.
     """
-    os.makedirs(cache_dir, exist_ok=True)
-    local_filename = os.path.join(cache_dir, f"Episode {ep_num}.vtt")
+    proc = subprocess.Popen(cmd, **kwargs)
+    try:
+        os.setpriority(os.PRIO_PROCESS, proc.pid, FFMPEG_NICENESS)
+    except OSError as e:
+        # ffmpeg may already have exited; it's only a priority hint anyway
+        logger.debug("Could not renice ffmpeg (pid %s): %s", proc.pid, e)
+    return proc
+
 
-    # Stream‐download via requests
-    response = requests.get(subtitle_url, stream=True, timeout=30)
-    response.raise_for_status()
+def download_and_rename_subtitle(subtitle_url, ep_num, cache_dir="subtitles_cache", session=SESSION):
+    """
+    Downloads subtitle from subtitle_url into a new "Episode {ep_num}-<random>.vtt"
+    in cache_dir, so concurrent jobs for the same episode number (other anime,
+    other chats) never share a file. Returns the local file path.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, local_filename = tempfile.mkstemp(prefix=f"Episode {ep_num}-", suffix=".vtt", dir=cache_dir)
 
-    with open(local_filename, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    try:
+        # Stream‐download via the shared session, copying the raw socket stream to disk
+        with os.fdopen(fd, "wb") as f, session.get(subtitle_url, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True   # still undo gzip/deflate transfer encoding
+            shutil.copyfileobj(response.raw, f, 64 * 1024)
+    except Exception:
+        os.remove(local_filename)
+        raise
 
     return local_filename
 
 
-def download_and_rename_video(hls_link, ep_num, cache_dir="videos_cache", progress_callback=None):
+def _load_media_playlist(session, hls_link):
     """
-    Uses ffprobe → ffmpeg to download an HLS stream into an MP4.
-    Reports progress via progress_callback(downloaded_mb, total_duration_s, percent, speed_mb_s, elapsed_s, eta_s).
+    Fetches `hls_link` and returns the parsed media playlist. A master playlist
+    is followed to its highest-bandwidth variant.
+    """
+    resp = session.get(hls_link, timeout=15)
+    resp.raise_for_status()
+    playlist = m3u8.loads(resp.text, uri=resp.url)
+
+    if playlist.is_variant:
+        best = max(playlist.playlists, key=lambda p: p.stream_info.bandwidth or 0)
+        resp = session.get(best.absolute_uri, timeout=15)
+        resp.raise_for_status()
+        playlist = m3u8.loads(resp.text, uri=resp.url)
 
-    Returns the local file path "Episode {ep_num}.mp4".
+    return playlist
+
+
+def _plain_segment_urls(playlist):
     """
-    os.makedirs(cache_dir, exist_ok=True)
-    output_path = os.path.join(cache_dir, f"Episode {ep_num}.mp4")
+    Returns the URLs whose bytes, concatenated in order, form the stream (the
+    init section first, if there is one). Returns None when the stream needs
+    ffmpeg's own HLS demuxer: encrypted segments, byte-range segments or
+    init sections (a plain GET would fetch the whole file), several init
+    sections, or an empty playlist.
+    """
+    if not playlist.segments:
+        return None
+    if any(key is not None and (key.method or "NONE").upper() != "NONE" for key in playlist.keys):
+        return None
+    if any(seg.byterange or (seg.init_section and seg.init_section.byterange) for seg in playlist.segments):
+        return None
+
+    init_urls = {seg.init_section.absolute_uri for seg in playlist.segments if seg.init_section}
+    if len(init_urls) > 1:
+        return None
 
-    # 1) Use ffprobe to get total duration (in seconds)
+    return list(init_urls) + [seg.absolute_uri for seg in playlist.segments]
+
+
+def _feed_segments(session, segment_urls, sink):
+    """
+    Downloads `segment_urls` with HLS_FETCH_WORKERS requests in flight and
+    writes their bodies to `sink` in playlist order. At most twice that many
+    segments are buffered in memory at any time.
+    """
+    def fetch(url):
+        resp = session.get(url, timeout=30)
+        resp.raise_for_status()
+        return resp.content
+
+    urls = iter(segment_urls)
+    with ThreadPoolExecutor(max_workers=HLS_FETCH_WORKERS) as pool:
+        pending = deque(pool.submit(fetch, url) for url in islice(urls, HLS_FETCH_WORKERS * 2))
+        try:
+            while pending:
+                data = pending.popleft().result()
+                next_url = next(urls, None)
+                if next_url is not None:
+                    pending.append(pool.submit(fetch, next_url))
+                sink.write(data)
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+
+def _probe_duration(hls_link):
+    """Uses ffprobe to get the total duration of `hls_link` (in seconds)."""
     try:
         cmd_probe = [
             "ffprobe",
@@ -43,27 +154,67 @@ def download_and_rename_video(hls_link, ep_num, cache_dir="videos_cache", progre
             hls_link
         ]
         result = subprocess.run(cmd_probe, capture_output=True, text=True, timeout=15)
-        duration = float(result.stdout.strip())
+        return float(result.stdout.strip())
     except Exception as e:
         raise RuntimeError(f"Failed to get duration via ffprobe: {e}")
 
-    # 2) Run ffmpeg with "-progress pipe:1" to get periodic progress on stdout
+
+def _start_feeder(proc, feed, errors):
+    """
+    Runs feed(proc.stdin) on a helper thread, closing ffmpeg's stdin when it is
+    done. Exceptions are appended to `errors` (ffmpeg exits cleanly on a short
+    stdin, so the caller must check them). Returns the started thread.
+    """
+    def pump():
+        try:
+            feed(proc.stdin)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=pump, daemon=True)
+    feeder.start()
+    return feeder
+
+
+def _run_ffmpeg(input_arg, output_path, duration, progress_callback=None, feed=None):
+    """
+    Runs ffmpeg (stream copy into MP4) with "-progress pipe:1" and turns its
+    periodic progress lines into progress_callback calls. When `feed` is given,
+    ffmpeg reads from stdin and feed(stdin) is run on a helper thread to write
+    the input.
+    """
     cmd_ffmpeg = [
         "ffmpeg",
-        "-i", hls_link,
+        "-y",
+        "-i", input_arg,
         "-c", "copy",
         "-bsf:a", "aac_adtstoasc",   # fix AAC frames if needed
         "-progress", "pipe:1",
         "-nostats",
+        "-threads", str(FFMPEG_THREADS),
         output_path
     ]
-    proc = subprocess.Popen(cmd_ffmpeg, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1)
+    proc = _popen_ffmpeg(
+        cmd_ffmpeg,
+        stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    progress_out = io.TextIOWrapper(proc.stdout, encoding="utf-8", errors="replace")
+
+    feed_errors = []
+    feeder = _start_feeder(proc, feed, feed_errors) if feed is not None else None
 
-    start_time = time.time()
+    start_time = time.monotonic()
     downloaded_mb = 0.0
 
     while True:
-        line = proc.stdout.readline()
+        line = progress_out.readline()
         if not line:
             # If process ended, break
             if proc.poll() is not None:
@@ -92,7 +243,7 @@ def download_and_rename_video(hls_link, ep_num, cache_dir="videos_cache", progre
                 size_bytes = 0
             downloaded_mb = size_bytes / (1024 * 1024)
 
-            elapsed = time.time() - start_time
+            elapsed = time.monotonic() - start_time
             speed = downloaded_mb / elapsed if elapsed > 0 else 0
 
             # ETA = elapsed × (100 – percent) / percent
@@ -109,7 +260,7 @@ def download_and_rename_video(hls_link, ep_num, cache_dir="videos_cache", progre
                 downloaded_mb = size_bytes / (1024 * 1024)
             except OSError:
                 downloaded_mb = downloaded_mb
-            elapsed = time.time() - start_time
+            elapsed = time.monotonic() - start_time
             speed = downloaded_mb / elapsed if elapsed > 0 else 0
             percent = 100.0
             eta = 0.0
@@ -119,7 +270,174 @@ def download_and_rename_video(hls_link, ep_num, cache_dir="videos_cache", progre
             break
 
     retcode = proc.wait()
+    if feeder is not None:
+        feeder.join()
     if retcode != 0:
         raise RuntimeError(f"ffmpeg failed with code {retcode}")
+    if feed_errors:
+        # ffmpeg exits cleanly on a short stdin, so a failed fetch must not pass as success
+        raise RuntimeError(f"Failed to fetch HLS segments: {feed_errors[0]}")
 
     return output_path
+
+
+def download_and_rename_video(hls_link, ep_num, cache_dir="videos_cache", progress_callback=None):
+    """
+    Downloads an HLS stream into an MP4 with ffmpeg (stream copy, no re-encode).
+    For plain (unencrypted) playlists the segments are fetched in parallel and
+    piped into ffmpeg's stdin; otherwise, or if that fails, ffprobe → ffmpeg
+    read the playlist themselves.
+    Reports progress via progress_callback(downloaded_mb, total_duration_s, percent, speed_mb_s, elapsed_s, eta_s).
+
+    Returns the local file path, a new "Episode {ep_num}-<random>.mp4" in
+    cache_dir so concurrent jobs for the same episode number never share a file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, output_path = tempfile.mkstemp(prefix=f"Episode {ep_num}-", suffix=".mp4", dir=cache_dir)
+    os.close(fd)   # ffmpeg (-y) writes the file itself
+
+    try:
+        return _download_video_to(output_path, hls_link, ep_num, progress_callback)
+    except Exception:
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+        raise
+
+
+def _download_video_to(output_path, hls_link, ep_num, progress_callback):
+    """The body of download_and_rename_video, writing into `output_path`."""
+    try:
+        playlist = _load_media_playlist(SESSION, hls_link)
+        segment_urls = _plain_segment_urls(playlist)
+    except Exception as e:
+        logger.warning("Could not parse HLS playlist for Episode %s (%s); letting ffmpeg fetch it", ep_num, e)
+        segment_urls = None
+
+    if segment_urls:
+        # The playlist already carries the duration, so ffprobe isn't needed here
+        duration = sum(seg.duration or 0 for seg in playlist.segments)
+        try:
+            return _run_ffmpeg(
+                "pipe:0",
+                output_path,
+                duration,
+                progress_callback,
+                feed=lambda sink: _feed_segments(SESSION, segment_urls, sink),
+            )
+        except Exception as e:
+            logger.warning("Parallel HLS fetch failed for Episode %s (%s); retrying via ffmpeg", ep_num, e)
+
+    duration = _probe_duration(hls_link)
+    return _run_ffmpeg(hls_link, output_path, duration, progress_callback)
+
+
+def estimate_hls_size(hls_link):
+    """
+    Rough size in bytes of `hls_link` (BANDWIDTH × duration of the variant
+    download_and_rename_video would pick), or None if the master playlist
+    doesn't advertise a bandwidth.
+    """
+    resp = SESSION.get(hls_link, timeout=15)
+    resp.raise_for_status()
+    master = m3u8.loads(resp.text, uri=resp.url)
+    if not master.is_variant:
+        return None
+
+    best = max(master.playlists, key=lambda p: p.stream_info.bandwidth or 0)
+    if not best.stream_info.bandwidth:
+        return None
+    media = _load_media_playlist(SESSION, best.absolute_uri)
+
+    duration = sum(seg.duration or 0 for seg in media.segments)
+    return int(best.stream_info.bandwidth * duration / 8)
+
+
+def _report_stream_progress(progress_out, duration, progress_callback):
+    """
+    Drains ffmpeg's "-progress" output (text lines on a binary pipe) and calls
+    progress_callback(percent) as out_time advances, if a duration is known.
+    """
+    for raw_line in progress_out:
+        key, _, val = raw_line.decode("utf-8", "replace").strip().partition("=")
+        if key != "out_time_ms" or not progress_callback or not duration:
+            continue
+        try:
+            # out_time_ms is the number of microseconds of video already processed
+            current_time_s = int(val) / 1e6
+        except ValueError:
+            continue
+        progress_callback(min(100.0, current_time_s / duration * 100))
+
+
+def stream_hls_as_fragmented_mp4(hls_link, chunk_size=64 * 1024, progress_callback=None):
+    """
+    Yields an MP4 of `hls_link` straight from ffmpeg's stdout, for uploads that
+    never touch the disk. The output is fragmented (frag_keyframe+empty_moov)
+    because the regular MP4 muxer needs a seekable file to write the index.
+    As in download_and_rename_video, plain playlists have their segments fetched
+    in parallel and piped into ffmpeg's stdin; others are read by ffmpeg itself.
+    progress_callback(percent) is called from a helper thread as ffmpeg works
+    through the stream, when the playlist duration is known.
+    Raises RuntimeError after the last chunk if ffmpeg or the segment fetch failed.
+    """
+    segment_urls = None
+    duration = None
+    try:
+        playlist = _load_media_playlist(SESSION, hls_link)
+        duration = sum(seg.duration or 0 for seg in playlist.segments) or None
+        segment_urls = _plain_segment_urls(playlist)
+    except Exception as e:
+        logger.warning("Could not parse HLS playlist %s (%s); letting ffmpeg fetch it", hls_link, e)
+
+    cmd_ffmpeg = [
+        "ffmpeg",
+        "-v", "error",
+        "-i", "pipe:0" if segment_urls else hls_link,
+        "-c", "copy",
+        "-bsf:a", "aac_adtstoasc",
+        "-threads", str(FFMPEG_THREADS),
+        "-progress", "pipe:2",
+        "-nostats",
+        "-f", "mp4",
+        "-movflags", "frag_keyframe+empty_moov",
+        "pipe:1"
+    ]
+    proc = _popen_ffmpeg(
+        cmd_ffmpeg,
+        stdin=subprocess.PIPE if segment_urls else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    feed_errors = []
+    feeder = None
+    if segment_urls:
+        feeder = _start_feeder(proc, lambda sink: _feed_segments(SESSION, segment_urls, sink), feed_errors)
+    threading.Thread(
+        target=_report_stream_progress,
+        args=(proc.stderr, duration, progress_callback),
+        daemon=True,
+    ).start()
+
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+        retcode = proc.wait()
+        if feeder is not None:
+            feeder.join()
+        if retcode != 0:
+            raise RuntimeError(f"ffmpeg failed with code {retcode}")
+        if feed_errors:
+            raise RuntimeError(f"Failed to fetch HLS segments: {feed_errors[0]}")
+    finally:
+        # Consumer gave up early (or errored): don't leave ffmpeg running. The
+        # feeder then fails on the closed pipe and exits on its own.
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()